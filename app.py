@@ -1,82 +1,151 @@
 import streamlit as st
 import os
-import traceback
 import time
 import random
-import uuid
+import secrets
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain, islice
 from datetime import datetime
+try:
+    # C ISO-8601 parser, used for uploaded histories when installed
+    from ciso8601 import parse_datetime as _parse_datetime
+except ImportError:
+    _parse_datetime = datetime.fromisoformat
 from typing import Dict, List, Optional, Tuple
-from korean_utils import KoreanTextProcessor
-from ui_components import UIComponents
-from langdetect import detect
+from korean_utils import KoreanTextProcessor, CONTEXT_WINDOW, INSTRUCTION_MARKER, extract_last_user_message
+try:
+    import pycld2
+except ImportError:
+    pycld2 = None
 import json
+import html
+try:
+    import orjson
+except ImportError:
+    orjson = None
+import re
+import logging
+import logging.handlers
+import queue
+
+logger = logging.getLogger(__name__)
+
+# Hangul syllables U+AC00..U+D7A3; the C regex scanner stops at the first hit
+_HANGUL_RE = re.compile(r'[\uAC00-\uD7A3]')
+
+# CLD2 misreads URL- and symbol-heavy text, so those are stripped before it runs
+_URL_RE = re.compile(r'https?://\S+')
+_SYMBOL_RUN_RE = re.compile(r'[^\w\s]{2,}')
+
+def is_korean(text):
+    """True if the text contains at least one Hangul syllable"""
+    return _HANGUL_RE.search(text) is not None
+
+# Dedicated generator for mock replies, separate from the global random state
+_RNG = random.Random()
+
+# Mock replies, built once; only the chosen chat template is formatted per call
+_KO_TEXT_RESPONSES = (
+    "안녕하세요! 저는 HB AI입니다. 한국어로 자연스럽게 대화할 수 있습니다.",
+    "요청하신 내용에 대해 도움을 드리겠습니다. 더 구체적인 질문이 있으시면 언제든 말씀해 주세요.",
+    "한국어 텍스트 생성 기능이 정상적으로 작동하고 있습니다. 다양한 주제에 대해 질문해 보세요.",
+    "창의적인 아이디어를 제공하거나 학습에 도움을 드릴 수 있습니다. 어떤 도움이 필요하신가요?"
+)
+_EN_TEXT_RESPONSES = (
+    "Hello! I'm HB AI. I can communicate naturally in both Korean and English.",
+    "I'd be happy to help you with your request. Please feel free to ask more specific questions.",
+    "The Korean text generation feature is working properly. You can ask me about various topics.",
+    "I can provide creative ideas or help with learning. What kind of assistance do you need?"
+)
+_KO_CHAT_TEMPLATES = (
+    "'{msg}'에 대한 흥미로운 질문이네요! 자세히 설명해 드리겠습니다.",
+    "말씀하신 '{msg}' 관련해서 도움을 드릴 수 있습니다. 어떤 부분이 궁금하신가요?",
+    "네, 이해했습니다. 한국어로 자연스럽게 대화하며 도움을 드리겠습니다.",
+    "좋은 질문입니다! 더 자세한 정보를 원하시면 언제든 말씀해 주세요."
+)
+_EN_CHAT_TEMPLATES = (
+    "That's an interesting question about '{msg}'! Let me explain in detail.",
+    "I can help you with '{msg}'. What specific aspect would you like to know more about?",
+    "Yes, I understand. I'm here to help you with natural conversation in both languages.",
+    "Great question! Feel free to ask if you need more detailed information."
+)
+
+# Seconds of simulated model latency for the mock (e.g. HBAI_MOCK_SIMULATE_LATENCY=0.5); unset means instant.
+# Flag-style values also work: true/yes/on use the original 0.3s delay, false/no/off disable it
+MOCK_DEFAULT_LATENCY = 0.3
+
+def _read_mock_latency():
+    raw = os.getenv("HBAI_MOCK_SIMULATE_LATENCY", "").strip().lower()
+    if raw in ("", "0", "false", "no", "off"):
+        return 0.0
+    try:
+        return float(raw)
+    except ValueError:
+        if raw not in ("1", "true", "yes", "on"):
+            logger.warning("HBAI_MOCK_SIMULATE_LATENCY=%r is not a number, using %.1fs", raw, MOCK_DEFAULT_LATENCY)
+        return MOCK_DEFAULT_LATENCY
+
+_MOCK_LATENCY = _read_mock_latency()
 
 # Mock ModelManager for testing when dependencies are not available
 class MockModelManager:
-    def __init__(self):
+    def __init__(self, mock_latency=_MOCK_LATENCY):
         self.model = None
         self.tokenizer = None
         self.device = "cpu"
         self.model_name = "Qwen/Qwen2-7B-Instruct"
         self.is_mock = True
+        # Seconds to sleep per response; 0 returns immediately
+        self.mock_latency = mock_latency
 
     def load_model(self, progress_callback=None):
         """Mock model loading with progress simulation"""
         try:
             if progress_callback:
-                for i in range(1, 11):
-                    time.sleep(0.01) # Very fast load simulation
-                    progress_callback(i, 10, "로드 중...")
+                progress_callback(5, 10, "로드 중...")
+                progress_callback(10, 10, "로드 완료!")
             self.model = "mock_model"
             self.tokenizer = "mock_tokenizer"
             return True
         except Exception as e:
-            print(f"Error in mock model loading: {str(e)}")
+            logger.error("Error in mock model loading: %s", e)
             return False
 
     def generate_text(self, prompt, max_length=200, temperature=0.7, top_p=0.9):
         """Generate mock text response"""
-        time.sleep(0.3)
-        korean_responses = [
-            "안녕하세요! 저는 HB AI입니다. 한국어로 자연스럽게 대화할 수 있습니다.",
-            "요청하신 내용에 대해 도움을 드리겠습니다. 더 구체적인 질문이 있으시면 언제든 말씀해 주세요.",
-            "한국어 텍스트 생성 기능이 정상적으로 작동하고 있습니다. 다양한 주제에 대해 질문해 보세요.",
-            "창의적인 아이디어를 제공하거나 학습에 도움을 드릴 수 있습니다. 어떤 도움이 필요하신가요?"
-        ]
-        english_responses = [
-            "Hello! I'm HB AI. I can communicate naturally in both Korean and English.",
-            "I'd be happy to help you with your request. Please feel free to ask more specific questions.",
-            "The Korean text generation feature is working properly. You can ask me about various topics.",
-            "I can provide creative ideas or help with learning. What kind of assistance do you need?"
-        ]
-        if any(ord(char) >= 0xAC00 and ord(char) <= 0xD7A3 for char in prompt):
-            return random.choice(korean_responses)
+        if self.mock_latency:
+            time.sleep(self.mock_latency)
+        if is_korean(prompt):
+            return _RNG.choice(_KO_TEXT_RESPONSES)
         else:
-            return random.choice(english_responses)
+            return _RNG.choice(_EN_TEXT_RESPONSES)
 
     def generate_chat_response(self, conversation_context, max_length=300, temperature=0.7, top_p=0.9):
         """Generate mock chat response"""
-        time.sleep(0.3)
-        if "user\n" in conversation_context:
-            last_message = conversation_context.split("user\n")[-1].split("<|im_end|>")[0].strip()
-        else:
-            last_message = "Hello"
-        korean_chat_responses = [
-            f"'{last_message}'에 대한 흥미로운 질문이네요! 자세히 설명해 드리겠습니다.",
-            f"말씀하신 '{last_message}' 관련해서 도움을 드릴 수 있습니다. 어떤 부분이 궁금하신가요?",
-            "네, 이해했습니다. 한국어로 자연스럽게 대화하며 도움을 드리겠습니다.",
-            "좋은 질문입니다! 더 자세한 정보를 원하시면 언제든 말씀해 주세요."
-        ]
-        english_chat_responses = [
-            f"That's an interesting question about '{last_message}'! Let me explain in detail.",
-            f"I can help you with '{last_message}'. What specific aspect would you like to know more about?",
-            "Yes, I understand. I'm here to help you with natural conversation in both languages.",
-            "Great question! Feel free to ask if you need more detailed information."
-        ]
-        if any(ord(char) >= 0xAC00 and ord(char) <= 0xD7A3 for char in last_message):
-            return random.choice(korean_chat_responses)
+        if self.mock_latency:
+            time.sleep(self.mock_latency)
+        return self._mock_chat_reply(conversation_context)
+
+    def generate_chat_stream(self, conversation_context, max_length=300, temperature=0.7, top_p=0.9):
+        """Yield a mock chat response word by word"""
+        words = self._mock_chat_reply(conversation_context).split(' ')
+        # Spread the simulated latency over the words instead of a single upfront wait
+        delay = self.mock_latency / len(words)
+        for n, word in enumerate(words):
+            if delay:
+                time.sleep(delay)
+            yield word if n == 0 else ' ' + word
+
+    def _mock_chat_reply(self, conversation_context):
+        last_message = extract_last_user_message(conversation_context, "Hello")
+        if is_korean(last_message):
+            template = _RNG.choice(_KO_CHAT_TEMPLATES)
         else:
-            return random.choice(english_chat_responses)
+            template = _RNG.choice(_EN_CHAT_TEMPLATES)
+        return template.format(msg=last_message)
 
     def cleanup(self):
         self.model = None
@@ -94,21 +163,6 @@ class MockModelManager:
             "memory_usage": 0
         }
 
-try:
-    from huggingface_model_manager import HuggingFaceModelManager
-    ModelManager = HuggingFaceModelManager
-    USE_REAL_MODEL = True
-    MODEL_TYPE = "HuggingFace API"
-except ImportError:
-    try:
-        from model_manager import ModelManager
-        USE_REAL_MODEL = True
-        MODEL_TYPE = "Local Model"
-    except ImportError:
-        ModelManager = MockModelManager
-        USE_REAL_MODEL = False
-        MODEL_TYPE = "Mock Model"
-
 st.set_page_config(
     page_title="HB AI - 한국어 AI 채팅",
     page_icon="🤖",
@@ -116,31 +170,177 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Streamlit reruns this script on every interaction; build the singletons once per process
+@st.cache_resource
+def setup_logging():
+    # Handlers only enqueue records; the listener thread does the stream I/O off the request thread
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    for name in (__name__, "model_manager", "huggingface_model_manager"):
+        module_logger = logging.getLogger(name)
+        module_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        module_logger.setLevel(os.getenv("HBAI_LOG_LEVEL", "INFO").upper())
+        module_logger.propagate = False
+    return listener
+
+setup_logging()
+
+@st.cache_resource
+def get_korean_processor():
+    return KoreanTextProcessor()
+
+@st.cache_resource
+def get_model_manager():
+    # Imported here so the first paint doesn't wait on the backend's dependencies
+    try:
+        from huggingface_model_manager import HuggingFaceModelManager as ModelManager
+    except ImportError:
+        try:
+            from model_manager import ModelManager
+        except ImportError:
+            ModelManager = MockModelManager
+    return ModelManager()
+
+@st.cache_resource
+def get_mock_manager():
+    return MockModelManager()
+
+@st.cache_resource
+def get_background_executor():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="hbai")
+
+@st.cache_resource
+def start_model_load():
+    # Runs once per process off the script thread, so the page renders while the model loads;
+    # cleared after a failed load so a later message can try again
+    return get_background_executor().submit(get_model_manager().load_model)
+
+# Back-off between load retries after a failure, doubling up to the cap
+LOAD_RETRY_BASE_SECONDS = 5
+LOAD_RETRY_MAX_SECONDS = 300
+
+@st.cache_resource
+def get_load_retry_state():
+    return {'lock': threading.Lock(), 'not_before': 0.0, 'delay': LOAD_RETRY_BASE_SECONDS}
+
+@st.cache_resource
+def get_language_detector_factory():
+    # Imported and parsed on first non-Korean, non-ASCII message; seeded so the same text always gets the same answer
+    from langdetect import DetectorFactory, PROFILES_DIRECTORY
+    DetectorFactory.seed = 0
+    factory = DetectorFactory()
+    factory.load_profile(PROFILES_DIRECTORY)
+    return factory
+
+# Longer inputs are detected uncached so the cache never pins large strings
+DETECT_CACHE_MAX_CHARS = 256
+
+def detect_input_language(text):
+    """Language code of the user's message, defaulting to Korean when detection fails"""
+    # Any Hangul syllable settles it without running the n-gram detector
+    if is_korean(text):
+        return 'ko'
+    # Pure ASCII can't be Korean, and anything non-Korean gets the English instruction
+    if text.isascii():
+        return 'en'
+    key = text.strip().lower()
+    if len(key) > DETECT_CACHE_MAX_CHARS:
+        return _detect_language(key)
+    return _detect_language_cached(key)
+
+def _detect_language(text):
+    # CLD2 (optional) is a compiled classifier; langdetect remains the fallback when it is missing or unsure
+    if pycld2 is not None:
+        try:
+            is_reliable, _, details = pycld2.detect(_SYMBOL_RUN_RE.sub(' ', _URL_RE.sub('', text)))
+            if is_reliable:
+                return details[0][1]
+        except Exception:
+            pass
+    try:
+        detector = get_language_detector_factory().create()
+        detector.append(text)
+        return detector.detect()
+    except Exception:
+        return 'ko'
+
+_detect_language_cached = lru_cache(maxsize=1024)(_detect_language)
+
+def ensure_model_loaded(wait=False):
+    """Poll the shared background load, optionally waiting for it; the manager tracks its own loaded state"""
+    retry = get_load_retry_state()
+    # After a failed load, stay on the mock until the back-off has passed
+    if time.monotonic() < retry['not_before']:
+        return False
+    load_future = start_model_load()
+    if not wait and not load_future.done():
+        return False
+    try:
+        load_future.result()
+    except Exception:
+        st.error("AI 모델 로딩에 실패했습니다. Mock 모델로 전환합니다.")
+    if get_model_manager().is_loaded():
+        return True
+    with retry['lock']:
+        # Another session may already have started the retry for this failure
+        if start_model_load() is load_future:
+            start_model_load.clear()
+            retry['not_before'] = time.monotonic() + retry['delay']
+            retry['delay'] = min(retry['delay'] * 2, LOAD_RETRY_MAX_SECONDS)
+    return False
+
+# Messages kept live per session; older ones move to 'archived' and are only rendered on request
+MAX_LIVE_MESSAGES = 200
+
+# Sessions kept per browser session; the least recently updated ones are dropped beyond this
+MAX_SESSIONS = 100
+
 class ChatSessionManager:
     def __init__(self):
-        self.sessions = {}
+        # Kept in most-recently-updated-first order so listing needs no sort
+        self.sessions = OrderedDict()
         self.current_session_id = None
+        # Serialized export, rebuilt only after sessions change
+        self._export_cache = None
 
     def create_new_session(self, is_temporary=False):
-        session_id = str(uuid.uuid4())
+        session_id = secrets.token_hex(8)
         session_data = {
             'id': session_id,
             'title': self._generate_session_title(),
-            'messages': [],
+            'messages': deque(maxlen=MAX_LIVE_MESSAGES),
+            'archived': [],
+            'title_set': False,
             'created_at': datetime.now(),
-            'last_updated': datetime.now()
+            # Integer nanoseconds: only used for ordering, and cheaper than datetime
+            'last_updated': time.time_ns()
         }
         if not is_temporary:
             self.sessions[session_id] = session_data
+            self.sessions.move_to_end(session_id, last=False)
+            self.evict_stale_sessions()
+            self.invalidate_export()
         self.current_session_id = session_id
         return session_id, session_data
 
+    def evict_stale_sessions(self):
+        # MRU order puts the least recently updated session last
+        while len(self.sessions) > MAX_SESSIONS:
+            evicted_id, _ = self.sessions.popitem(last=True)
+            # An upload of newer sessions can push out the one being viewed
+            if evicted_id == self.current_session_id:
+                self.current_session_id = next(iter(self.sessions), None)
+
     def get_current_session(self):
         if self.current_session_id:
             if self.current_session_id in self.sessions:
                 return self.sessions[self.current_session_id]
-            elif hasattr(st.session_state, 'temp_session') and st.session_state.temp_session['id'] == self.current_session_id:
-                return st.session_state.temp_session
+            temp_session = st.session_state.get('temp_session')
+            if temp_session and temp_session['id'] == self.current_session_id:
+                return temp_session
         return None
 
     def switch_session(self, session_id):
@@ -152,174 +352,297 @@ class ChatSessionManager:
     def add_message(self, role, content):
         current_session = self.get_current_session()
         if current_session:
+            # One clock read serves both the message timestamp and the session's sort key
+            now_ns = time.time_ns()
             message = {
                 'role': role,
                 'content': content,
-                'timestamp': datetime.now()
+                'timestamp': datetime.fromtimestamp(now_ns / 1_000_000_000),
+                '_html': render_message_html(role, content),
+                '_turn': korean_processor.format_turn(role, content)
             }
-            current_session['messages'].append(message)
-            current_session['last_updated'] = datetime.now()
-            if len(current_session['messages']) == 2 and role == 'assistant':
+            messages = current_session['messages']
+            if len(messages) == messages.maxlen:
+                current_session['archived'].append(messages[0])
+            messages.append(message)
+            current_session['last_updated'] = now_ns
+            self.invalidate_export()
+            if self.current_session_id in self.sessions:
+                self.sessions.move_to_end(self.current_session_id, last=False)
+            # Sessions from older exports have no flag; they are titled once they have a reply
+            if role == 'assistant' and not current_session.setdefault('title_set', len(current_session['messages']) > 2):
                 user_message = current_session['messages'][0]['content']
                 current_session['title'] = self._generate_title_from_message(user_message)
+                current_session['title_set'] = True
+
+    def get_context_turns(self, session, count=CONTEXT_WINDOW):
+        # Each message is formatted for the model once; uploaded messages catch up here
+        recent = list(islice(reversed(session['messages']), count))
+        turns = []
+        for message in reversed(recent):
+            turn = message.get('_turn')
+            if turn is None:
+                turn = message['_turn'] = korean_processor.format_turn(message['role'], message['content'])
+            turns.append(turn)
+        return turns
+
+    def invalidate_export(self):
+        self._export_cache = None
+
+    def export_json(self):
+        if self._export_cache is not None:
+            return self._export_cache
+        # Underscore keys are derived caches and are rebuilt after upload;
+        # archived and live messages are exported as one list
+        def public(d):
+            return {k: v for k, v in d.items() if not k.startswith('_') and k != 'archived'}
+        export = {
+            sid: {**public(s), 'messages': [public(m) for m in chain(s.get('archived', ()), s['messages'])]}
+            for sid, s in self.sessions.items()
+        }
+        # orjson encodes datetimes natively in C and returns bytes, which download_button takes as-is
+        if orjson is not None:
+            self._export_cache = orjson.dumps(export, default=str)
+        else:
+            self._export_cache = json.dumps(export, default=str, separators=(',', ':'))
+        return self._export_cache
 
     def delete_session(self, session_id):
         if session_id in self.sessions:
             del self.sessions[session_id]
+            self.invalidate_export()
             if self.current_session_id == session_id:
-                new_session_list = self.get_session_list()
-                if new_session_list:
-                    self.current_session_id = new_session_list[0]['id']
-                else:
-                    self.current_session_id = None
+                # MRU order: the first remaining session is the most recently updated
+                self.current_session_id = next(iter(self.sessions), None)
 
     def get_session_list(self):
-        sessions = list(self.sessions.values())
-        return sorted(sessions, key=lambda x: x['last_updated'], reverse=True)
+        return list(self.sessions.values())
 
     def _generate_session_title(self):
-        return "새 채팅" if st.session_state.get('language', 'ko') == 'ko' else "New Chat"
+        return _STRINGS[st.session_state.get('language', 'ko')]['session_title']
 
     def _generate_title_from_message(self, message):
         if len(message) > 30:
             return message[:30] + "..."
         return message
 
-if 'language' not in st.session_state:
-    st.session_state.language = 'ko'
-if 'chat_session_manager' not in st.session_state:
-    st.session_state.chat_session_manager = ChatSessionManager()
-if 'model_manager' not in st.session_state:
-    st.session_state.model_manager = None
-if 'temp_session' not in st.session_state:
-    st.session_state.temp_session = None
-if 'model_loaded' not in st.session_state:
-    st.session_state.model_loaded = False
-
-if not st.session_state.model_loaded:
-    with st.spinner("AI 모델을 로드하는 중..."):
-        if not st.session_state.model_manager:
-            st.session_state.model_manager = ModelManager()
-        try:
-            st.session_state.model_manager.load_model()
-            st.session_state.model_loaded = True
-        except:
-            st.session_state.model_loaded = False
-            st.error("AI 모델 로딩에 실패했습니다. Mock 모델로 전환합니다.")
+# Callables are factories, only invoked when the key is missing
+_SESSION_DEFAULTS = {
+    'language': 'ko',
+    'chat_session_manager': ChatSessionManager,
+    'temp_session': None,
+}
+
+def _bootstrap():
+    """Fill session defaults and kick off the shared model load once per browser session"""
+    state = st.session_state
+    if state.get('_booted'):
+        return
+    for key, default in _SESSION_DEFAULTS.items():
+        if key not in state:
+            state[key] = default() if callable(default) else default
+    ensure_model_loaded()
+    state._booted = True
+
+korean_processor = get_korean_processor()
+
+# UI strings per language; render functions look the table up once per rerun
+_STRINGS = {
+    'ko': {
+        'new_chat': "✨ 새 채팅",
+        'recent': "최근 기록",
+        'delete_help': "이 채팅만 삭제합니다.",
+        'settings': "⚙️ 설정",
+        'settings_todo': "설정 기능은 아직 구현되지 않았습니다.",
+        'placeholder': "메시지를 입력하세요...",
+        'show_archived': "이전 메시지 {n}개 보기",
+        'session_title': "새 채팅",
+        'generating': "AI가 응답을 생성하는 중입니다...",
+        'generation_failed': "응답 생성에 실패했습니다. 다시 시도해주세요.",
+        'chat_error': "채팅 처리 중 오류가 발생했습니다: {error}",
+    },
+    'en': {
+        'new_chat': "✨ New Chat",
+        'recent': "Recent",
+        'delete_help': "Delete this chat only",
+        'settings': "⚙️ Settings",
+        'settings_todo': "Settings not yet implemented.",
+        'placeholder': "Type your message...",
+        'show_archived': "Show {n} earlier messages",
+        'session_title': "New Chat",
+        'generating': "AI is generating response...",
+        'generation_failed': "Failed to generate response. Please try again.",
+        'chat_error': "Error processing chat: {error}",
+    },
+}
+
+# Static markup, built once at import instead of on every rerun
+_MAIN_CSS = """
+<style>
+.main {
+    background-color: #f5f5f5;
+}
+.stButton>button {
+    border: 1px solid #ddd;
+    border-radius: 20px;
+    background-color: white;
+    color: #333;
+    padding: 8px 16px;
+}
+.stButton>button:hover {
+    border-color: #bbb;
+}
+.st-chat-message-container .st-chat-message-bubble {
+    border-radius: 18px;
+    padding: 15px;
+    margin: 10px 0;
+    line-height: 1.5;
+    box-shadow: 0 1px 3px rgba(0,0,0,0.1);
+}
+.st-chat-message-container .st-chat-message-bubble.user {
+    background-color: #007bff;
+    color: white;
+    text-align: right;
+}
+.st-chat-message-container .st-chat-message-bubble.assistant {
+    background-color: #e9ecef;
+    color: black;
+    text-align: left;
+}
+.st-emotion-cache-1r650o1 {
+    padding-top: 0rem;
+}
+.st-emotion-cache-16270h4 {
+    padding-left: 0rem;
+    padding-right: 0rem;
+}
+.st-emotion-cache-1h9999r {
+    border: none;
+    box-shadow: none;
+}
+.st-emotion-cache-1qg0590 {
+    padding: 0;
+}
+.st-emotion-cache-9r12l8 {
+    padding-top: 2rem;
+}
+</style>
+"""
+
+_WELCOME_HTML = """
+<div style="text-align: center; margin-top: 10vh;">
+    <h1 style="font-size: 3rem; color: #444;">
+        <span style="background: linear-gradient(to right, #4285f4, #ea4335, #fbbc05, #34a853); -webkit-background-clip: text; -webkit-text-fill-color: transparent;">HB AI</span>
+    </h1>
+    <p style="font-size: 1.2rem; color: #666;">
+        무엇이든 물어보세요.
+    </p>
+</div>
+---
+<h3 style="text-align: center;">예시</h3>
+<script>
+    function setInputValue(value) {
+        const input = document.querySelector('input[placeholder^="메시지를"]');
+        if (input) {
+            input.value = value;
+            input.focus();
+        }
+    }
+</script>
+"""
+
+_SUGGESTION_GRID_OPEN = '<div style="display: grid; grid-template-columns: 1fr 1fr; gap: 10px;">'
+# {js_arg} is a JSON string literal, escaped again for the attribute so quotes in a suggestion can't break out
+_SUGGESTION_CARD_HTML = (
+    '<div style="border: 1px solid #ddd; padding: 15px; border-radius: 12px; cursor: pointer;" onclick="setInputValue({js_arg})">'
+    '<p><strong>{text}</strong></p>'
+    '</div>'
+)
 
-ui = UIComponents()
-korean_processor = KoreanTextProcessor()
+_SUGGESTIONS = (
+    "양자 컴퓨터를 쉽게 설명해 줘.",
+    "창의적인 아이디어가 필요해. 새로운 앱 아이디어를 3가지 추천해 줄 수 있을까?",
+    "파이썬의 제너레이터와 이터레이터의 차이점을 알려 줘.",
+    "유럽 여행을 위한 가성비 좋은 도시 5곳을 추천해 줘.",
+    "재미있는 SF 소설 줄거리를 요약해 줘.",
+    "건강한 점심 메뉴 3가지와 레시피를 알려 줘.",
+    "2050년 미래의 학교는 어떤 모습일까?",
+    "영화 '인터스텔라'의 과학적 배경을 설명해 줘."
+)
+
+_USER_BUBBLE_PREFIX = '<div class="st-chat-message-bubble user">👤 <strong>You</strong><br>'
+_ASSISTANT_BUBBLE_PREFIX = '<div class="st-chat-message-bubble assistant">🤖 <strong>HB AI</strong><br>'
+# The bubble rules in _MAIN_CSS are scoped to this container
+_MESSAGES_OPEN = '<div class="st-chat-message-container">'
+_BUBBLE_PREFIXES = {'user': _USER_BUBBLE_PREFIX, 'assistant': _ASSISTANT_BUBBLE_PREFIX}
 
 def main():
-    st.markdown(
-        """
-        <style>
-        .main {
-            background-color: #f5f5f5;
-        }
-        .stButton>button {
-            border: 1px solid #ddd;
-            border-radius: 20px;
-            background-color: white;
-            color: #333;
-            padding: 8px 16px;
-        }
-        .stButton>button:hover {
-            border-color: #bbb;
-        }
-        .st-chat-message-container .st-chat-message-bubble {
-            border-radius: 18px;
-            padding: 15px;
-            margin: 10px 0;
-            line-height: 1.5;
-            box-shadow: 0 1px 3px rgba(0,0,0,0.1);
-        }
-        .st-chat-message-container .st-chat-message-bubble.user {
-            background-color: #007bff;
-            color: white;
-            text-align: right;
-        }
-        .st-chat-message-container .st-chat-message-bubble.assistant {
-            background-color: #e9ecef;
-            color: black;
-            text-align: left;
-        }
-        .st-emotion-cache-1r650o1 {
-            padding-top: 0rem;
-        }
-        .st-emotion-cache-16270h4 {
-            padding-left: 0rem;
-            padding-right: 0rem;
-        }
-        .st-emotion-cache-1h9999r {
-            border: none;
-            box-shadow: none;
-        }
-        .st-emotion-cache-1qg0590 {
-            padding: 0;
-        }
-        .st-emotion-cache-9r12l8 {
-            padding-top: 2rem;
-        }
-        </style>
-        """,
-        unsafe_allow_html=True
-    )
+    _bootstrap()
+    # Streamlit drops elements a rerun doesn't re-emit, so the styles are sent on every full rerun;
+    # st.html sends the <style> block as-is without a markdown pass, and chat-fragment reruns skip it
+    st.html(_MAIN_CSS)
     with st.sidebar:
         render_chat_sidebar()
     render_main_chat_area()
 
+@st.fragment
+def render_download_section(session_manager):
+    # The export is built on request inside this fragment, so chat messages never need a full
+    # rerun just to refresh the download data
+    if st.button("📦 채팅 기록 다운로드 준비", use_container_width=True):
+        st.download_button(
+            label="📥 모든 채팅 기록 다운로드",
+            data=session_manager.export_json(),
+            file_name=f"HBAI_all_chats_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+            mime="application/json",
+            help="모든 대화 기록을 하나의 JSON 파일로 저장합니다.",
+            # Downloading changes nothing on the page, so skip the rerun it would otherwise trigger
+            on_click="ignore"
+        )
+
 def render_chat_sidebar():
     session_manager = st.session_state.chat_session_manager
+    L = _STRINGS[st.session_state.language]
     st.title("HB AI 🤖")
     st.markdown("---")
 
-    if st.button(
-        "✨ New Chat" if st.session_state.language == 'en' else "✨ 새 채팅",
+    # Callbacks run before the rerun Streamlit already does, so no explicit st.rerun() is needed
+    st.button(
+        L['new_chat'],
         use_container_width=True,
-        type="primary"
-    ):
-        session_id, _ = session_manager.create_new_session()
-        st.rerun()
-
-    st.subheader(
-        "Recent" if st.session_state.language == 'en' else "최근 기록"
+        type="primary",
+        on_click=_new_chat
     )
 
+    st.subheader(L['recent'])
+
     sessions = session_manager.get_session_list()
     for session in sessions:
         is_current = session_manager.current_session_id == session['id']
         
         col1, col2 = st.columns([4, 1])
         with col1:
-            if st.button(
+            st.button(
                 f"{session['title']}",
                 key=f"session_{session['id']}",
                 type="primary" if is_current else "secondary",
-                use_container_width=True
-            ):
-                session_manager.switch_session(session['id'])
-                st.rerun()
+                use_container_width=True,
+                on_click=session_manager.switch_session,
+                args=(session['id'],)
+            )
         
         with col2:
-            if st.button(
+            st.button(
                 "🗑️",
                 key=f"delete_{session['id']}",
-                help="이 채팅만 삭제합니다." if st.session_state.language == 'ko' else "Delete this chat only"
-            ):
-                session_manager.delete_session(session['id'])
-                st.rerun()
+                help=L['delete_help'],
+                on_click=session_manager.delete_session,
+                args=(session['id'],)
+            )
 
     st.markdown("---")
     
-    all_sessions_data = json.dumps(session_manager.sessions, default=str, indent=2)
-    st.download_button(
-        label="📥 모든 채팅 기록 다운로드",
-        data=all_sessions_data,
-        file_name=f"HBAI_all_chats_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-        mime="application/json",
-        help="모든 대화 기록을 하나의 JSON 파일로 저장합니다."
-    )
+    render_download_section(session_manager)
     
     uploaded_file = st.file_uploader(
         "📤 채팅 기록 업로드",
@@ -328,22 +651,37 @@ def render_chat_sidebar():
     )
     if uploaded_file is not None:
         try:
-            uploaded_data = json.load(uploaded_file)
+            uploaded_data = orjson.loads(uploaded_file.getvalue()) if orjson is not None else json.load(uploaded_file)
+            parse_dt = _parse_datetime
             for session_id, session_data in uploaded_data.items():
                 if session_id not in session_manager.sessions:
                     # Fix: Convert string dates to datetime objects
-                    if 'last_updated' in session_data and isinstance(session_data['last_updated'], str):
-                        session_data['last_updated'] = datetime.fromisoformat(session_data['last_updated'])
-                    if 'created_at' in session_data and isinstance(session_data['created_at'], str):
-                        session_data['created_at'] = datetime.fromisoformat(session_data['created_at'])
+                    # Older exports stored last_updated as an ISO string
+                    last_updated = session_data.get('last_updated')
+                    if isinstance(last_updated, str):
+                        session_data['last_updated'] = int(parse_dt(last_updated).timestamp() * 1_000_000_000)
+                    created_at = session_data.get('created_at')
+                    if isinstance(created_at, str):
+                        session_data['created_at'] = parse_dt(created_at)
                     
                     # Fix: Also convert message timestamps
-                    if 'messages' in session_data:
-                        for message in session_data['messages']:
-                            if 'timestamp' in message and isinstance(message['timestamp'], str):
-                                message['timestamp'] = datetime.fromisoformat(message['timestamp'])
+                    messages = session_data.get('messages')
+                    if messages is not None:
+                        for message in messages:
+                            timestamp = message.get('timestamp')
+                            if isinstance(timestamp, str):
+                                message['timestamp'] = parse_dt(timestamp)
+                        # Same live/archived split that add_message maintains
+                        session_data['archived'] = messages[:-MAX_LIVE_MESSAGES]
+                        session_data['messages'] = deque(messages[-MAX_LIVE_MESSAGES:], maxlen=MAX_LIVE_MESSAGES)
                                 
                     session_manager.sessions[session_id] = session_data
+            # Uploaded sessions can be newer than existing ones; restore MRU order once
+            session_manager.sessions = OrderedDict(
+                sorted(session_manager.sessions.items(), key=lambda x: x[1]['last_updated'], reverse=True)
+            )
+            session_manager.evict_stale_sessions()
+            session_manager.invalidate_export()
             st.success("대화 기록을 성공적으로 불러왔습니다!")
             st.rerun()
         except Exception as e:
@@ -354,20 +692,36 @@ def render_chat_sidebar():
     col1, col2 = st.columns(2)
     with col1:
         if st.button(
-            "⚙️ Settings" if st.session_state.language == 'en' else "⚙️ 설정",
+            L['settings'],
             use_container_width=True
         ):
-            st.info("Settings not yet implemented." if st.session_state.language == 'en' else "설정 기능은 아직 구현되지 않았습니다.")
+            st.info(L['settings_todo'])
     with col2:
-        if st.button(
+        st.button(
             "🌐 KO/EN",
-            use_container_width=True
-        ):
-            st.session_state.language = 'ko' if st.session_state.language == 'en' else 'en'
-            st.rerun()
-
+            use_container_width=True,
+            on_click=_toggle_language
+        )
+
+# Clicks closer together than this are treated as one, so a double-click makes a single session
+NEW_CHAT_DEBOUNCE_SECONDS = 0.3
+
+def _new_chat():
+    state = st.session_state
+    now = time.monotonic()
+    if now - state.get('_last_new_chat', 0.0) < NEW_CHAT_DEBOUNCE_SECONDS:
+        return
+    state._last_new_chat = now
+    state.chat_session_manager.create_new_session()
+
+def _toggle_language():
+    state = st.session_state
+    state.language = 'ko' if state.language == 'en' else 'en'
+
+@st.fragment
 def render_main_chat_area():
     session_manager = st.session_state.chat_session_manager
+    L = _STRINGS[st.session_state.language]
     current_session = session_manager.get_current_session()
     
     messages_container = st.container()
@@ -376,100 +730,66 @@ def render_main_chat_area():
         render_gemini_welcome_screen()
     else:
         with messages_container:
+            archived = current_session.get('archived')
+            if archived and st.toggle(L['show_archived'].format(n=len(archived))):
+                render_messages(archived)
             render_messages(current_session['messages'])
 
     with st.container():
         render_chat_input()
 
 def render_gemini_welcome_screen():
-    suggestions = [
-        "양자 컴퓨터를 쉽게 설명해 줘.",
-        "창의적인 아이디어가 필요해. 새로운 앱 아이디어를 3가지 추천해 줄 수 있을까?",
-        "파이썬의 제너레이터와 이터레이터의 차이점을 알려 줘.",
-        "유럽 여행을 위한 가성비 좋은 도시 5곳을 추천해 줘.",
-        "재미있는 SF 소설 줄거리를 요약해 줘.",
-        "건강한 점심 메뉴 3가지와 레시피를 알려 줘.",
-        "2050년 미래의 학교는 어떤 모습일까?",
-        "영화 '인터스텔라'의 과학적 배경을 설명해 줘."
-    ]
+    # Drawn once per browser session so the cards don't reshuffle on every rerun
+    if 'welcome_suggestions' not in st.session_state:
+        st.session_state.welcome_suggestions = random.sample(_SUGGESTIONS, 4)
+    selected_suggestions = st.session_state.welcome_suggestions
     
-    selected_suggestions = random.sample(suggestions, 4)
+    st.markdown(_WELCOME_HTML, unsafe_allow_html=True)
     
-    st.markdown(
-        f"""
-        <div style="text-align: center; margin-top: 10vh;">
-            <h1 style="font-size: 3rem; color: #444;">
-                <span style="background: linear-gradient(to right, #4285f4, #ea4335, #fbbc05, #34a853); -webkit-background-clip: text; -webkit-text-fill-color: transparent;">HB AI</span>
-            </h1>
-            <p style="font-size: 1.2rem; color: #666;">
-                무엇이든 물어보세요.
-            </p>
-        </div>
-        ---
-        <h3 style="text-align: center;">예시</h3>
-        <script>
-            function setInputValue(value) {{
-                const input = document.querySelector('input[placeholder^="메시지를"]');
-                if (input) {{
-                    input.value = value;
-                    input.focus();
-                }}
-            }}
-        </script>
-        """,
-        unsafe_allow_html=True
+    # One element for the whole 2x2 grid instead of a markdown call per card
+    cards = "".join(
+        _SUGGESTION_CARD_HTML.format(js_arg=html.escape(json.dumps(suggestion, ensure_ascii=False)), text=html.escape(suggestion))
+        for suggestion in selected_suggestions
     )
-    
-    cols = st.columns(2)
-    for i in range(4):
-        with cols[i % 2]:
-            st.markdown(
-                f"""
-                <div style="border: 1px solid #ddd; padding: 15px; border-radius: 12px; margin-bottom: 10px; cursor: pointer;" onclick="setInputValue('{selected_suggestions[i]}')">
-                    <p><strong>{selected_suggestions[i]}</strong></p>
-                </div>
-                """,
-                unsafe_allow_html=True
-            )
+    st.markdown(_SUGGESTION_GRID_OPEN + cards + '</div>', unsafe_allow_html=True)
+
+def render_message_html(role, content):
+    # Content is escaped so user or model text can't inject markup into the page
+    return _BUBBLE_PREFIXES.get(role, _ASSISTANT_BUBBLE_PREFIX) + html.escape(content) + '</div>'
 
 def render_messages(messages: List[Dict]):
+    html_parts = []
     for message in messages:
-        role = message['role']
-        content = message['content']
-
-        if role == 'user':
-            st.markdown(
-                f'<div class="st-chat-message-bubble user">👤 <strong>You</strong><br>{content}</div>',
-                unsafe_allow_html=True
-            )
-        else:
-            st.markdown(
-                f'<div class="st-chat-message-bubble assistant">🤖 <strong>HB AI</strong><br>{content}</div>',
-                unsafe_allow_html=True
-            )
+        # Markup is built once in add_message; uploaded messages get it on first render
+        bubble = message.get('_html')
+        if bubble is None:
+            bubble = message['_html'] = render_message_html(message['role'], message['content'])
+        html_parts.append(bubble)
+    # One element for the whole history instead of one frontend message per bubble
+    st.markdown(_MESSAGES_OPEN + "".join(html_parts) + '</div>', unsafe_allow_html=True)
 
 def render_chat_input():
-    st.markdown("---")
-    
-    with st.form(key="chat_form", clear_on_submit=True):
-        col1, col2 = st.columns([5, 1])
-        with col1:
-            user_input = st.text_input(
-                label="message",
-                placeholder="메시지를 입력하세요..." if st.session_state.language == 'ko' else "Type your message...",
-                label_visibility="collapsed",
-                autocomplete="off"
-            )
-        with col2:
-            send_button = st.form_submit_button(
-                "📤" if st.session_state.language == 'ko' else "📤",
-                use_container_width=True
-            )
-        if send_button and user_input.strip():
-            process_chat_message(user_input.strip())
-            st.rerun()
+    L = _STRINGS[st.session_state.language]
+    # chat_input submits and clears itself, without a form round-trip
+    user_input = st.chat_input(placeholder=L['placeholder'])
+    if user_input and user_input.strip():
+        session_manager = st.session_state.chat_session_manager
+        sidebar_state = _sidebar_state(session_manager)
+        process_chat_message(user_input.strip())
+        # Redraw only the chat fragment unless the sidebar's session list order or titles changed
+        st.rerun(scope="app" if _sidebar_state(session_manager) != sidebar_state else "fragment")
+
+def _sidebar_state(session_manager):
+    """What the sidebar shows that a chat message can change: list order and the current title"""
+    current_session = session_manager.get_current_session()
+    return (
+        next(iter(session_manager.sessions), None),
+        session_manager.current_session_id,
+        current_session['title'] if current_session else None
+    )
 
 def process_chat_message(user_input):
+    L = _STRINGS[st.session_state.language]
     try:
         session_manager = st.session_state.chat_session_manager
         if not session_manager.current_session_id:
@@ -477,49 +797,57 @@ def process_chat_message(user_input):
         
         session_manager.add_message("user", user_input)
         
-        detected_lang = 'ko'
-        try:
-            detected_lang = detect(user_input)
-        except:
-            pass
+        detected_lang = detect_input_language(user_input)
 
-        temp_chat_history = [(msg['role'], msg['content']) for msg in session_manager.get_current_session()['messages']]
+        context_turns = session_manager.get_context_turns(session_manager.get_current_session())
         
         lang_instruction = "응답은 무조건 한국어로 해주세요." if detected_lang == 'ko' else "Please respond strictly in English."
-        temp_chat_history[-1] = ('user', f"{user_input}\n\n[INSTRUCTION]: {lang_instruction}")
+        context_turns[-1] = korean_processor.format_turn('user', f"{user_input}{INSTRUCTION_MARKER}{lang_instruction}")
         
-        with st.spinner(
-            "AI가 응답을 생성하는 중입니다..." if st.session_state.language == 'ko' else "AI is generating response..."
-        ):
+        with st.spinner(L['generating']):
             response = None
-            conversation_context = korean_processor.prepare_chat_context(temp_chat_history)
+            conversation_context = korean_processor.build_chat_context(context_turns)
+            # Only a message that actually needs the model waits for a load still in progress
+            model_manager = get_model_manager()
+            if not model_manager.is_loaded():
+                with st.spinner("AI 모델을 로드하는 중..."):
+                    ensure_model_loaded(wait=True)
               
-            if st.session_state.model_loaded and st.session_state.model_manager:
+            if model_manager.is_loaded():
                 try:
-                    response = st.session_state.model_manager.generate_chat_response(
-                        conversation_context,  
-                        max_length=300,  
-                        temperature=0.7,  
-                        top_p=0.9  
-                    )  
+                    # Stream when the backend supports it so the first words show immediately
+                    if hasattr(model_manager, 'generate_chat_stream'):
+                        response = st.write_stream(model_manager.generate_chat_stream(
+                            conversation_context,
+                            max_length=300,
+                            temperature=0.7,
+                            top_p=0.9
+                        ))
+                    else:
+                        response = model_manager.generate_chat_response(
+                            conversation_context,  
+                            max_length=300,  
+                            temperature=0.7,  
+                            top_p=0.9  
+                        )  
                 except Exception as e:
-                    print(f"Real model failed: {str(e)}")
+                    logger.exception("Real model failed: %s", e)
                     response = None
               
             if not response:
-                print("Using mock response fallback")
-                mock_manager = MockModelManager()
-                response = mock_manager.generate_chat_response(user_input)
+                logger.info("Using mock response fallback")
+                mock_manager = get_mock_manager()
+                response = st.write_stream(mock_manager.generate_chat_stream(user_input))
               
             if response:
                 processed_response = korean_processor.post_process_response(response)
                 session_manager.add_message("assistant", processed_response)
             else:
-                error_msg = ("응답 생성에 실패했습니다. 다시 시도해주세요." if st.session_state.language == 'ko' else "Failed to generate response. Please try again.")
+                error_msg = L['generation_failed']
                 session_manager.add_message("assistant", error_msg)
       
     except Exception as e:
-        error_msg = (f"채팅 처리 중 오류가 발생했습니다: {str(e)}" if st.session_state.language == 'ko' else f"Error processing chat: {str(e)}")
+        error_msg = L['chat_error'].format(error=str(e))
         st.error(error_msg)
 
 if __name__ == "__main__":
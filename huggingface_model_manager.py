@@ -1,16 +1,40 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 import time
 import os
-from typing import Optional, Callable
+import re
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Callable, Iterator
+from korean_utils import INSTRUCTION_MARKER, extract_last_user_message
+
+# The process locale does not change at runtime, so resolve it once
+LANG_IS_KO = os.getenv('LANG', '').startswith('ko')
+
+logger = logging.getLogger(__name__)
+
+# Short prompts without these markers are cheap enough for the fast model
+FAST_MODEL_MAX_WORDS = 15
+COMPLEX_KEYWORDS = ("```", "코드", "code", "설명", "explain", "분석", "analyze", "번역", "translate", "왜", "why")
+
+RESPONSE_CACHE_SIZE = 256
+
+# 503 means the model is still warming up; wait and retry a bounded number of times
+MAX_503_RETRIES = 5
+MAX_RETRY_WAIT = 30
+_CACHE_TRIM_RE = re.compile(r'[\s\.\?!~,]+')
 
 class HuggingFaceModelManager:
     def __init__(self):
         # Use OpenRouter for reliable OpenAI-compatible API access to Qwen2 7B specifically
-        self.model_options = [
-            "qwen/qwen-2.5-7b-instruct"  # ONLY use the requested Qwen2 7B model
-        ]
-        self.model_name = self.model_options[0]
+        self.model_name = "qwen/qwen-2.5-7b-instruct"  # ONLY use the requested Qwen2 7B model
         
         # Use OpenRouter API - reliable OpenAI-compatible endpoint
         self.api_base = os.getenv('API_BASE_URL', 'https://openrouter.ai/api/v1')
@@ -22,128 +46,204 @@ class HuggingFaceModelManager:
         if api_key:
             self.headers["Authorization"] = f"Bearer {api_key}"
         
+        # OpenRouter provider routing: prefer the provider with the lowest latency (set empty to disable)
+        self.provider_sort = os.getenv('OPENROUTER_PROVIDER_SORT', 'latency')
+        # Request fields that never change between calls
+        self._payload_template = {"provider": {"sort": self.provider_sort}} if self.provider_sort else {}
+        
+        # Optional smaller model for trivial queries (e.g. greetings); unset keeps every turn on Qwen2 7B
+        self.fast_model_name = os.getenv('OPENROUTER_FAST_MODEL', '').strip()
+        
+        # Only the last user message is sent upstream, so replies can be reused per normalised prompt
+        self.response_cache = OrderedDict()
+        # The manager is shared by every script thread, so cache reads and writes are serialised
+        self._cache_lock = threading.Lock()
+        
+        # One pooled session so turns reuse the keep-alive TLS connection instead of reconnecting
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # OpenRouter-specific headers for better routing
+        self.session.headers.update({
+            "HTTP-Referer": "https://hb-ai.replit.app",
+            "X-Title": "HB AI - Korean AI Chat System"
+        })
+        # Only failures to connect are retried by the adapter: the request never reached the server,
+        # so re-sending cannot bill a duplicate generation. Read timeouts and 5xx replies are not
+        # retried (POST is outside the default allowed_methods); 503 keeps its own wait loop
+        retry = Retry(total=2, connect=2, read=0, backoff_factor=0.5, raise_on_status=False)
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry))
+        
         self.device = "openrouter-api"
         self.model_loaded = False
-        self.current_model_index = 0
         
     def load_model(self, progress_callback: Optional[Callable] = None) -> bool:
         """Initialize connection to Hugging Face API"""
         try:
             if progress_callback:
-                progress_callback(1, 10, "API 연결 확인 중..." if os.getenv('LANG', '').startswith('ko') else "Checking API connection...")
-            
-            # Check API healthiness first
-            if progress_callback:
-                progress_callback(3, 10, "API 상태 확인 중..." if os.getenv('LANG', '').startswith('ko') else "Checking API health...")
+                progress_callback(1, 10, "API 연결 확인 중..." if LANG_IS_KO else "Checking API connection...")
             
-            # Test if the API base supports /v1/models endpoint
-            models_url = f"{self.api_base}/models"
-            try:
-                models_response = requests.get(models_url, headers=self.headers, timeout=10)
-                if models_response.status_code == 404:
-                    print(f"WARNING: API base {self.api_base} doesn't support /v1/models endpoint")
-                elif models_response.status_code == 200:
-                    print(f"API health check successful: {len(models_response.json().get('data', []))} models available")
-            except Exception as e:
-                print(f"API health check failed: {str(e)}")
+            # OpenRouter rejects every request without a key, so don't spend a round trip finding out
+            if "Authorization" not in self.headers:
+                logger.warning("OPENROUTER_API_KEY is not set")
+                if progress_callback:
+                    progress_callback(10, 10, "Qwen2 7B 모델 연결 실패 - API 키를 확인하세요" if LANG_IS_KO else "Qwen2 7B model failed - check API key")
+                return False
             
-            # Test connection with a simple request
             if progress_callback:
-                progress_callback(5, 10, "모델 연결 테스트 중..." if os.getenv('LANG', '').startswith('ko') else "Testing model connection...")
+                progress_callback(5, 10, f"모델 테스트 중: {self.model_name}" if LANG_IS_KO else f"Testing model: {self.model_name}")
             
-            # Try models in order until one works
-            for i, model in enumerate(self.model_options):
-                # Clean and validate model name
-                self.model_name = model.strip()
-                self.current_model_index = i
-                
-                print(f"DEBUG: Trying model {i+1}/{len(self.model_options)}: {self.model_name}")
-                print(f"DEBUG: Using chat completions API: {self.api_url}")
-                
+            # One minimal completion doubles as the health check
+            logger.debug("Using chat completions API: %s", self.api_url)
+            if self._make_chat_completion("ping", max_tokens=1) is not None:
+                self.model_loaded = True
                 if progress_callback:
-                    progress_callback(5 + i, 10, f"모델 테스트 중: {model}" if os.getenv('LANG', '').startswith('ko') else f"Testing model: {model}")
-                
-                # Test with a simple chat completion
-                test_response = self._make_chat_completion("Hello", max_tokens=10)
-                
-                if test_response:
-                    self.model_loaded = True
-                    if progress_callback:
-                        progress_callback(10, 10, f"연결 성공: {model}" if os.getenv('LANG', '').startswith('ko') else f"Connected: {model}")
-                    return True
-                else:
-                    print(f"Model {model} failed, trying next...")
+                    progress_callback(10, 10, f"연결 성공: {self.model_name}" if LANG_IS_KO else f"Connected: {self.model_name}")
+                return True
             
             # Qwen2 7B model failed
             if progress_callback:
-                progress_callback(10, 10, "Qwen2 7B 모델 연결 실패 - API 키를 확인하세요" if os.getenv('LANG', '').startswith('ko') else "Qwen2 7B model failed - check API key")
+                progress_callback(10, 10, "Qwen2 7B 모델 연결 실패 - API 키를 확인하세요" if LANG_IS_KO else "Qwen2 7B model failed - check API key")
             return False
                 
         except Exception as e:
-            print(f"Error connecting to Hugging Face API: {str(e)}")
+            logger.exception("Error connecting to Hugging Face API: %s", e)
             return False
     
-    def _make_chat_completion(self, prompt: str, max_tokens: int = 200, temperature: float = 0.7, top_p: float = 0.9) -> Optional[str]:
-        """Make chat completion request to new HuggingFace API (2025)"""
+    def route_model(self, prompt: str) -> str:
+        """Pick the fast model for short, simple prompts and the main model otherwise"""
+        if not self.fast_model_name or len(prompt.split()) >= FAST_MODEL_MAX_WORDS:
+            return self.model_name
+        lowered = prompt.lower()
+        if any(k in lowered for k in COMPLEX_KEYWORDS):
+            return self.model_name
+        return self.fast_model_name
+    
+    def _cache_key(self, prompt: str, model: str) -> tuple:
+        """Normalise case, whitespace and trailing punctuation so near-duplicates share an entry"""
+        return model, _CACHE_TRIM_RE.sub(' ', prompt.lower()).strip()
+    
+    def _cache_get(self, key: tuple) -> Optional[str]:
+        with self._cache_lock:
+            response = self.response_cache.get(key)
+            if response is not None:
+                self.response_cache.move_to_end(key)
+            return response
+    
+    def _cache_put(self, key: tuple, response: str):
+        with self._cache_lock:
+            self.response_cache[key] = response
+            self.response_cache.move_to_end(key)
+            if len(self.response_cache) > RESPONSE_CACHE_SIZE:
+                self.response_cache.popitem(last=False)
+    
+    def _build_chat_payload(self, prompt: str, max_tokens: int, temperature: float, top_p: float, stream: bool, model: Optional[str] = None) -> dict:
+        """Build the payload for a chat completion request"""
+        # OpenAI-compatible chat completions format
+        return {
+            **self._payload_template,
+            "model": model or self.model_name,
+            "messages": [
+                {"role": "user", "content": prompt}
+            ],
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "stream": stream
+        }
+    
+    def _stream_chat_completion(self, prompt: str, max_tokens: int = 200, temperature: float = 0.7, top_p: float = 0.9, model: Optional[str] = None, status: Optional[dict] = None) -> Iterator[str]:
+        """Yield content deltas from a streamed (SSE) chat completion"""
+        # status["complete"] is set only once the server ends the stream ([DONE] or a finish_reason),
+        # so callers can tell a finished reply from one cut off by an error
         try:
-            print(f"DEBUG: Making chat completion to: {self.api_url}")
-            print(f"DEBUG: Model name: {self.model_name}")
-            print(f"DEBUG: Has auth header: {'Authorization' in self.headers}")
+            payload = self._build_chat_payload(prompt, max_tokens, temperature, top_p, stream=True, model=model)
             
-            # OpenAI-compatible chat completions format
-            payload = {
-                "model": self.model_name,
-                "messages": [
-                    {"role": "user", "content": prompt}
-                ],
-                "max_tokens": max_tokens,
-                "temperature": temperature,
-                "top_p": top_p,
-                "stream": False
-            }
-            
-            # Add OpenRouter-specific headers for better routing
-            request_headers = self.headers.copy()
-            request_headers["HTTP-Referer"] = "https://hb-ai.replit.app"
-            request_headers["X-Title"] = "HB AI - Korean AI Chat System"
-            
-            response = requests.post(
+            with self.session.post(
                 self.api_url,
-                headers=request_headers,
                 json=payload,
+                stream=True,
                 timeout=30
-            )
+            ) as response:
+                if response.status_code != 200:
+                    logger.error("API Error: %s - %s", response.status_code, response.text)
+                    return
+                
+                # Lines stay bytes: the JSON parser decodes UTF-8 itself, and text/event-stream
+                # without a charset would otherwise default to latin-1
+                for line in response.iter_lines():
+                    if not line.startswith(b"data: "):
+                        continue
+                    data = line[len(b"data: "):]
+                    if data == b"[DONE]":
+                        if status is not None:
+                            status["complete"] = True
+                        break
+                    choices = json_loads(data).get("choices")
+                    if choices:
+                        delta = choices[0].get("delta", {}).get("content")
+                        if delta:
+                            yield delta
+                        if choices[0].get("finish_reason") and status is not None:
+                            status["complete"] = True
+                            
+        except Exception as e:
+            logger.error("Streaming request error: %s", e)
+    
+    def _make_chat_completion(self, prompt: str, max_tokens: int = 200, temperature: float = 0.7, top_p: float = 0.9, model: Optional[str] = None) -> Optional[str]:
+        """Make chat completion request to new HuggingFace API (2025)"""
+        try:
+            logger.debug("Making chat completion to: %s", self.api_url)
+            logger.debug("Model name: %s", model or self.model_name)
+            logger.debug("Has auth header: %s", 'Authorization' in self.headers)
             
-            print(f"DEBUG: Response status: {response.status_code}")
-            if response.status_code != 200:
-                print(f"DEBUG: Error response: {response.text}")
+            payload = self._build_chat_payload(prompt, max_tokens, temperature, top_p, stream=False, model=model)
             
-            if response.status_code == 200:
-                result = response.json()
-                if "choices" in result and len(result["choices"]) > 0:
-                    return result["choices"][0]["message"]["content"].strip()
-            elif response.status_code == 503:
-                print(f"Model loading, waiting...")
-                time.sleep(3)
-                return self._make_chat_completion(prompt, max_tokens, temperature, top_p)
-            elif response.status_code == 404:
-                print(f"Model not found: {self.model_name}")
-                return None
-            elif response.status_code == 400:
-                print(f"Bad request: {response.text}")
-                return None
-            else:
-                print(f"API Error: {response.status_code} - {response.text}")
-                return None
+            for attempt in range(MAX_503_RETRIES + 1):
+                response = self.session.post(
+                    self.api_url,
+                    json=payload,
+                    timeout=30
+                )
+                
+                logger.debug("Response status: %s", response.status_code)
+                if response.status_code != 200:
+                    logger.debug("Error response: %s", response.text)
+                
+                if response.status_code == 200:
+                    result = json_loads(response.content)
+                    if "choices" in result and len(result["choices"]) > 0:
+                        return result["choices"][0]["message"]["content"].strip()
+                    return None
+                elif response.status_code == 503 and attempt < MAX_503_RETRIES:
+                    # Honour the server's Retry-After when given, otherwise back off exponentially
+                    wait = min(self._retry_after(response, 2 ** attempt), MAX_RETRY_WAIT)
+                    logger.info("Model loading, waiting %.1fs...", wait)
+                    time.sleep(wait)
+                elif response.status_code == 404:
+                    logger.error("Model not found: %s", self.model_name)
+                    return None
+                elif response.status_code == 400:
+                    logger.error("Bad request: %s", response.text)
+                    return None
+                else:
+                    logger.error("API Error: %s - %s", response.status_code, response.text)
+                    return None
                 
         except Exception as e:
-            print(f"Request error: {str(e)}")
+            logger.error("Request error: %s", e)
             return None
     
+    @staticmethod
+    def _retry_after(response, default: float) -> float:
+        try:
+            return float(response.headers.get("Retry-After", default))
+        except ValueError:
+            return default
+    
     def generate_text(self, prompt: str, max_length: int = 200, temperature: float = 0.7, top_p: float = 0.9) -> Optional[str]:
         """Generate text using OpenRouter Chat Completions API"""
         if not self.model_loaded:
-            print("Model not loaded, cannot generate text")
+            logger.warning("Model not loaded, cannot generate text")
             return None
         
         return self._make_chat_completion(prompt, max_length, temperature, top_p)
@@ -151,20 +251,55 @@ class HuggingFaceModelManager:
     def generate_chat_response(self, conversation_context: str, max_length: int = 300, temperature: float = 0.7, top_p: float = 0.9) -> Optional[str]:
         """Generate chat response using OpenRouter Chat Completions API"""
         if not self.model_loaded:
-            print("Model not loaded, cannot generate chat response")
+            logger.warning("Model not loaded, cannot generate chat response")
             return None
         
         # Extract the last user message for chat completion
-        if "user\n" in conversation_context:
-            last_message = conversation_context.split("user\n")[-1].split("<|im_end|>")[0].strip()
-        else:
-            last_message = conversation_context
+        last_message = extract_last_user_message(conversation_context, conversation_context)
+        
+        # Route and cache on what the user typed, not the appended response-language instruction
+        user_text = last_message.partition(INSTRUCTION_MARKER)[0]
+        model = self.route_model(user_text)
+        key = self._cache_key(user_text, model)
+        response = self._cache_get(key)
+        if response is None:
+            response = self._make_chat_completion(last_message, max_length, temperature, top_p, model)
+            if response:
+                self._cache_put(key, response)
+        return response
+    
+    def generate_chat_stream(self, conversation_context: str, max_length: int = 300, temperature: float = 0.7, top_p: float = 0.9) -> Iterator[str]:
+        """Stream chat response tokens using OpenRouter Chat Completions API"""
+        if not self.model_loaded:
+            logger.warning("Model not loaded, cannot stream chat response")
+            return
+        
+        # Extract the last user message for chat completion
+        last_message = extract_last_user_message(conversation_context, conversation_context)
+        
+        # Route and cache on what the user typed, not the appended response-language instruction
+        user_text = last_message.partition(INSTRUCTION_MARKER)[0]
+        model = self.route_model(user_text)
+        key = self._cache_key(user_text, model)
+        response = self._cache_get(key)
+        if response is not None:
+            yield response
+            return
         
-        return self._make_chat_completion(last_message, max_length, temperature, top_p)
+        parts = []
+        status = {}
+        for delta in self._stream_chat_completion(last_message, max_length, temperature, top_p, model, status):
+            parts.append(delta)
+            yield delta
+        # A stream cut short is shown once but never cached for other sessions
+        if parts and status.get("complete"):
+            self._cache_put(key, "".join(parts).strip())
     
     def cleanup(self):
         """Clean up (no local resources to clean)"""
         self.model_loaded = False
+        with self._cache_lock:
+            self.response_cache.clear()
     
     def is_loaded(self) -> bool:
         """Check if API connection is ready"""
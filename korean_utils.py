@@ -1,19 +1,96 @@
 import re
-from typing import List, Tuple
+from itertools import islice
+from typing import List, Optional, Sequence, Tuple
+
+# Number of most recent messages sent to the model as context
+CONTEXT_WINDOW = 10
+
+# Separates the user's text from the response-language instruction appended to the last turn
+INSTRUCTION_MARKER = "\n\n[INSTRUCTION]: "
+
+# System message for Korean support
+SYSTEM_TURN = "<|im_start|>system\n당신은 한국어와 영어를 모두 지원하는 도움이 되는 AI 어시스턴트입니다. 사용자의 언어에 맞춰 적절하게 응답해주세요.<|im_end|>"
+
+# Patterns compiled once at import; the matching helpers below reuse them on every response
+_KOREAN_RE = re.compile(r'[가-힣]+')
+_MIXED_RE = re.compile(r'[가-힣a-zA-Z0-9\s.,!?]+')
+_SPECIAL_TOKEN_RE = re.compile(r'<\|.*?\|>')
+# Runs of one repeated newline or space collapse to a single character
+_WS_RUN_RE = re.compile(r'([\n ])\1+')
+# All four spacing fixes in one left-to-right pass; see fix_korean_spacing for the cases
+_SPACING_RE = re.compile(
+    r' +([,.!?;:])([가-힣a-zA-Z])?'   # spaces before punctuation (and a word glued after it)
+    r'|([,.!?;:])([가-힣a-zA-Z])'     # punctuation glued to the next word
+    r'| +\('                         # runs of spaces before '('
+    r'|\) +(?![ ,.!?;:])'             # runs of spaces after ')', unless the run ends at punctuation
+)
+# Hangul and Latin runs; detect_language counts both in one scan
+_LANG_RUN_RE = re.compile(r'[가-힣]+|[a-zA-Z]+')
+
+# Sentence-ending checks: one endswith over a tuple, one scan for any question word
+_PROPER_ENDINGS = ('.', '!', '?', '습니다', '입니다', '어요', '아요', '에요')
+_QUESTION_WORDS_RE = re.compile(r'무엇|어떻게|왜|언제|어디서|누가|what|how|why|when|where|who', re.IGNORECASE)
+
+# UI messages per language, built once
+_UI_MESSAGES_KO = {
+    'loading': '로딩 중...',
+    'error': '오류가 발생했습니다.',
+    'success': '성공적으로 완료되었습니다.',
+    'empty_prompt': '프롬프트를 입력해주세요.',
+    'generating': '생성 중...',
+    'model_loading': '모델을 로드하는 중입니다...',
+    'model_loaded': '모델이 로드되었습니다.',
+    'chat_placeholder': '메시지를 입력하세요...',
+    'send': '전송',
+    'clear': '지우기',
+    'generate': '생성하기'
+}
+
+_UI_MESSAGES_EN = {
+    'loading': 'Loading...',
+    'error': 'An error occurred.',
+    'success': 'Completed successfully.',
+    'empty_prompt': 'Please enter a prompt.',
+    'generating': 'Generating...',
+    'model_loading': 'Loading model...',
+    'model_loaded': 'Model loaded.',
+    'chat_placeholder': 'Type your message...',
+    'send': 'Send',
+    'clear': 'Clear',
+    'generate': 'Generate'
+}
+
+def _spacing_replacement(match) -> str:
+    punct, word, glued_punct, glued_word = match.groups()
+    if punct is not None:
+        return punct + ' ' + word if word else punct
+    if glued_punct is not None:
+        return glued_punct + ' ' + glued_word
+    return ' (' if match.group().endswith('(') else ') '
+
+def extract_last_user_message(conversation_context: str, default: str) -> str:
+    """Return the last user turn of a ChatML context without splitting the whole history"""
+    start = conversation_context.rfind("user\n")
+    if start < 0:
+        return default
+    start += len("user\n")
+    end = conversation_context.find("<|im_end|>", start)
+    return conversation_context[start:end if end >= 0 else None].strip()
 
 class KoreanTextProcessor:
     def __init__(self):
         # Korean text patterns
-        self.korean_pattern = re.compile(r'[가-힣]+')
-        self.mixed_pattern = re.compile(r'[가-힣a-zA-Z0-9\s.,!?]+')
+        self.korean_pattern = _KOREAN_RE
+        self.mixed_pattern = _MIXED_RE
         
         # Common Korean honorifics and endings
-        self.honorific_endings = ['습니다', '입니다', '드립니다', '어요', '아요', '에요']
-        self.question_endings = ['까요', '나요', '어요', '습니까']
+        self.honorific_endings = ('습니다', '입니다', '드립니다', '어요', '아요', '에요')
+        self.question_endings = ('까요', '나요', '어요', '습니까')
         
     def contains_korean(self, text: str) -> bool:
         """Check if text contains Korean characters"""
-        return bool(self.korean_pattern.search(text))
+        # isascii() reads CPython's cached string kind, so pure ASCII answers without a scan
+        return not text.isascii() and bool(self.korean_pattern.search(text))
     
     def prepare_generation_prompt(self, prompt: str) -> str:
         """Prepare prompt for Korean text generation"""
@@ -25,36 +102,46 @@ class KoreanTextProcessor:
         
         return formatted_prompt
     
-    def prepare_chat_context(self, chat_history: List[Tuple[str, str]]) -> str:
-        """Prepare chat context with proper formatting"""
-        context_parts = []
-        
-        # Add system message for Korean support
-        context_parts.append("<|im_start|>system\n당신은 한국어와 영어를 모두 지원하는 도움이 되는 AI 어시스턴트입니다. 사용자의 언어에 맞춰 적절하게 응답해주세요.<|im_end|>")
-        
-        # Add conversation history
-        for role, message in chat_history[-10:]:  # Keep last 10 messages for context
-            if role == "user":
-                context_parts.append(f"<|im_start|>user\n{message}<|im_end|>")
-            elif role == "assistant":
-                context_parts.append(f"<|im_start|>assistant\n{message}<|im_end|>")
+    def format_turn(self, role: str, message: str) -> str:
+        """Format a single conversation turn in chat template form"""
+        if role in ("user", "assistant"):
+            return f"<|im_start|>{role}\n{message}<|im_end|>"
+        return ""
+    
+    def build_chat_context(self, turns: List[str]) -> str:
+        """Assemble already formatted turns into a full chat context"""
+        context_parts = [SYSTEM_TURN]
+        context_parts.extend(turn for turn in turns if turn)
         
         # Add assistant start token
         context_parts.append("<|im_start|>assistant\n")
         
         return "\n".join(context_parts)
     
+    def prepare_chat_context(self, chat_history: Sequence[Tuple[str, str]]) -> str:
+        """Prepare chat context with proper formatting"""
+        # Keep only the most recent (role, text) pairs for context; reading from the end works
+        # for a deque of pairs as well as a list
+        recent = list(islice(reversed(chat_history), CONTEXT_WINDOW))
+        return self.build_chat_context(
+            [self.format_turn(role, message) for role, message in reversed(recent)]
+        )
+    
     def post_process_response(self, response: str) -> str:
         """Post-process AI response for better Korean text"""
         if not response:
             return response
         
+        # Plain ASCII with nothing to collapse: only the spacing fix can change it, and
+        # sentence endings only apply to Korean
+        if response.isascii() and '<|' not in response and '  ' not in response and '\n\n' not in response:
+            return self.fix_korean_spacing(response.strip())
+        
         # Remove any remaining special tokens
-        response = re.sub(r'<\|.*?\|>', '', response)
+        response = _SPECIAL_TOKEN_RE.sub('', response)
         
         # Clean up extra whitespace
-        response = re.sub(r'\n+', '\n', response)
-        response = re.sub(r' +', ' ', response)
+        response = _WS_RUN_RE.sub(r'\1', response)
         response = response.strip()
         
         # Fix common Korean spacing issues
@@ -67,40 +154,39 @@ class KoreanTextProcessor:
     
     def fix_korean_spacing(self, text: str) -> str:
         """Fix Korean text spacing issues"""
-        # Remove spaces before Korean punctuation
-        text = re.sub(r' +([,.!?;:])', r'\1', text)
-        
-        # Add space after punctuation if followed by Korean/English
-        text = re.sub(r'([,.!?;:])([가-힣a-zA-Z])', r'\1 \2', text)
-        
-        # Fix spacing around parentheses
-        text = re.sub(r' +\(', ' (', text)
-        text = re.sub(r'\) +', ') ', text)
-        
-        return text
+        # Remove spaces before Korean punctuation, add a space after punctuation followed by
+        # Korean/English, and collapse spacing around parentheses, in a single scan
+        return _SPACING_RE.sub(_spacing_replacement, text)
     
-    def fix_sentence_endings(self, text: str) -> str:
+    def fix_sentence_endings(self, text: str, has_korean: Optional[bool] = None) -> str:
         """Fix Korean sentence endings for politeness"""
         if not text:
             return text
+        if has_korean is None:
+            has_korean = self.contains_korean(text)
         
         # If text contains Korean and doesn't end with proper punctuation
-        if self.contains_korean(text) and not text.endswith(('.', '!', '?', '습니다', '입니다', '어요', '아요', '에요')):
+        if has_korean and not text.endswith(_PROPER_ENDINGS):
             # Check if it's a question
-            if any(word in text.lower() for word in ['무엇', '어떻게', '왜', '언제', '어디서', '누가', 'what', 'how', 'why', 'when', 'where', 'who']):
-                if not any(text.endswith(ending) for ending in self.question_endings):
+            if _QUESTION_WORDS_RE.search(text):
+                if not text.endswith(self.question_endings):
                     text += '까요?'
             else:
                 # Add polite ending
-                if not any(text.endswith(ending) for ending in self.honorific_endings):
+                if not text.endswith(self.honorific_endings):
                     text += '습니다.'
         
         return text
     
     def detect_language(self, text: str) -> str:
         """Detect if text is primarily Korean, English, or mixed"""
-        korean_chars = len(self.korean_pattern.findall(text))
-        total_chars = len(re.findall(r'[가-힣a-zA-Z]', text))
+        # Korean is weighed by runs (as korean_pattern matches them), letters by count
+        korean_chars = total_chars = 0
+        for match in _LANG_RUN_RE.finditer(text):
+            run = match.group()
+            total_chars += len(run)
+            if run[0] >= '가':
+                korean_chars += 1
         
         if total_chars == 0:
             return 'unknown'
@@ -122,45 +208,16 @@ class KoreanTextProcessor:
         # Clean and format the message
         formatted = self.post_process_response(message)
         
-        # Add appropriate formatting based on language
-        language = self.detect_language(formatted)
+        # User messages in Korean can be more casual
+        if is_user:
+            return formatted
         
-        if language == 'korean' and is_user:
-            # User messages in Korean can be more casual
-            pass
-        elif language == 'korean' and not is_user:
-            # AI responses should be polite
-            formatted = self.fix_sentence_endings(formatted)
+        # AI responses should be polite
+        if self.contains_korean(formatted):
+            formatted = self.fix_sentence_endings(formatted, has_korean=True)
         
         return formatted
     
     def get_language_specific_messages(self, lang: str = 'ko') -> dict:
         """Get language-specific UI messages"""
-        if lang == 'ko':
-            return {
-                'loading': '로딩 중...',
-                'error': '오류가 발생했습니다.',
-                'success': '성공적으로 완료되었습니다.',
-                'empty_prompt': '프롬프트를 입력해주세요.',
-                'generating': '생성 중...',
-                'model_loading': '모델을 로드하는 중입니다...',
-                'model_loaded': '모델이 로드되었습니다.',
-                'chat_placeholder': '메시지를 입력하세요...',
-                'send': '전송',
-                'clear': '지우기',
-                'generate': '생성하기'
-            }
-        else:
-            return {
-                'loading': 'Loading...',
-                'error': 'An error occurred.',
-                'success': 'Completed successfully.',
-                'empty_prompt': 'Please enter a prompt.',
-                'generating': 'Generating...',
-                'model_loading': 'Loading model...',
-                'model_loaded': 'Model loaded.',
-                'chat_placeholder': 'Type your message...',
-                'send': 'Send',
-                'clear': 'Clear',
-                'generate': 'Generate'
-            }
+        return _UI_MESSAGES_KO if lang == 'ko' else _UI_MESSAGES_EN
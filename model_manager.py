@@ -1,8 +1,29 @@
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, TextIteratorStreamer
 import gc
 import os
-from typing import Optional, Callable
+import logging
+import threading
+from typing import Optional, Callable, Iterator
+
+# The process locale does not change at runtime, so resolve it once
+LANG_IS_KO = os.getenv('LANG', '').startswith('ko')
+
+logger = logging.getLogger(__name__)
+
+# HBAI_QUANT selects the weight format: nf4 (default), int8, awq or none (full precision)
+QUANT_MODES = ("nf4", "int8", "awq", "none")
+AWQ_MODEL_NAME = "Qwen/Qwen2-7B-Instruct-AWQ"
+
+# HBAI_DTYPE picks the compute dtype: auto (bf16 where supported, else fp16 on CUDA / fp32 on CPU), bfloat16, float16, float32
+DTYPES = {"bfloat16": torch.bfloat16, "float16": torch.float16, "float32": torch.float32}
+
+# HBAI_ATTN selects the attention kernel (sdpa by default; flash_attention_2 needs the flash-attn package)
+ATTN_IMPLEMENTATION = os.getenv('HBAI_ATTN', 'sdpa')
+# HBAI_TORCH_COMPILE=1 compiles the decode forward pass; the first generation pays the compile cost
+TORCH_COMPILE = os.getenv('HBAI_TORCH_COMPILE', '') == '1'
+# Seconds generate_chat_stream waits for the next chunk before giving up
+STREAM_TIMEOUT = 60
 
 class ModelManager:
     def __init__(self):
@@ -10,6 +31,18 @@ class ModelManager:
         self.tokenizer = None
         self.device = None
         self.model_name = "Qwen/Qwen2-7B-Instruct"
+        # KV cache of the last chat generation and the token ids it covers; the next turn
+        # shares that prefix (system turn plus history), so only the new suffix is prefilled
+        self._kv = None
+        self._kv_ids = None
+        self._kv_lock = threading.Lock()
+        self.quantization = os.getenv('HBAI_QUANT', 'nf4').lower()
+        if self.quantization not in QUANT_MODES:
+            logger.warning("Unknown HBAI_QUANT %r, falling back to nf4", self.quantization)
+            self.quantization = "nf4"
+        if self.quantization == "awq":
+            # Pre-quantized 4-bit checkpoint; its quantization config ships with the weights
+            self.model_name = AWQ_MODEL_NAME
         
     def load_model(self, progress_callback: Optional[Callable] = None) -> bool:
         """Load the Qwen2 7B model with optimizations"""
@@ -19,26 +52,30 @@ class ModelManager:
             
             # Determine device and setup
             if progress_callback:
-                progress_callback(1, 10, "디바이스 설정 중..." if os.getenv('LANG', '').startswith('ko') else "Setting up device...")
+                progress_callback(1, 10, "디바이스 설정 중..." if LANG_IS_KO else "Setting up device...")
             
             self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            dtype = self._resolve_dtype()
             
             # Configure quantization for better performance
             quantization_config = None
-            if self.device == "cuda":
+            if self.device == "cuda" and self.quantization in ("nf4", "int8"):
                 try:
-                    quantization_config = BitsAndBytesConfig(
-                        load_in_4bit=True,
-                        bnb_4bit_compute_dtype=torch.float16,
-                        bnb_4bit_use_double_quant=True,
-                        bnb_4bit_quant_type="nf4"
-                    )
+                    if self.quantization == "int8":
+                        quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+                    else:
+                        quantization_config = BitsAndBytesConfig(
+                            load_in_4bit=True,
+                            bnb_4bit_compute_dtype=dtype,
+                            bnb_4bit_use_double_quant=True,
+                            bnb_4bit_quant_type="nf4"
+                        )
                 except:
                     quantization_config = None
             
             # Load tokenizer
             if progress_callback:
-                progress_callback(3, 10, "토크나이저 로드 중..." if os.getenv('LANG', '').startswith('ko') else "Loading tokenizer...")
+                progress_callback(3, 10, "토크나이저 로드 중..." if LANG_IS_KO else "Loading tokenizer...")
             
             self.tokenizer = AutoTokenizer.from_pretrained(
                 self.model_name,
@@ -52,11 +89,12 @@ class ModelManager:
             
             # Load model
             if progress_callback:
-                progress_callback(5, 10, "모델 로드 중..." if os.getenv('LANG', '').startswith('ko') else "Loading model...")
+                progress_callback(5, 10, "모델 로드 중..." if LANG_IS_KO else "Loading model...")
             
             model_kwargs = {
                 "trust_remote_code": True,
-                "torch_dtype": torch.float16 if self.device == "cuda" else torch.float32,
+                "torch_dtype": dtype,
+                "attn_implementation": ATTN_IMPLEMENTATION,
                 "device_map": "auto" if self.device == "cuda" else None,
             }
             
@@ -71,43 +109,65 @@ class ModelManager:
             # Move to device if not using device_map
             if self.device == "cpu":
                 if progress_callback:
-                    progress_callback(8, 10, "CPU로 모델 이동 중..." if os.getenv('LANG', '').startswith('ko') else "Moving model to CPU...")
+                    progress_callback(8, 10, "CPU로 모델 이동 중..." if LANG_IS_KO else "Moving model to CPU...")
                 self.model = self.model.to(self.device)
             
             # Set to evaluation mode
             self.model.eval()
             
+            if TORCH_COMPILE:
+                self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead")
+                # Warm up here, in the background load, so the first user message doesn't pay for tracing
+                self.generate_text("Hello", max_length=8)
+            
             if progress_callback:
-                progress_callback(10, 10, "로드 완료!" if os.getenv('LANG', '').startswith('ko') else "Load complete!")
+                progress_callback(10, 10, "로드 완료!" if LANG_IS_KO else "Load complete!")
             
             return True
             
         except Exception as e:
-            print(f"Error loading model: {str(e)}")
+            logger.exception("Error loading model: %s", e)
             return False
     
+    def _resolve_dtype(self):
+        """Pick the compute dtype from HBAI_DTYPE, defaulting to the fastest one the device supports"""
+        requested = os.getenv('HBAI_DTYPE', 'auto').lower()
+        if requested in DTYPES:
+            return DTYPES[requested]
+        if self.device != "cuda":
+            return torch.float32
+        # bf16 keeps fp32's range, so it is preferred on Ampere and newer
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    
+    def _to_device(self, inputs) -> dict:
+        """Move tokenizer output to the model device, copying asynchronously from pinned memory on CUDA"""
+        if self.device == "cuda":
+            # PyTorch's caching host allocator reuses the pinned blocks, so this stays cheap per call
+            return {k: v.pin_memory().to(self.device, non_blocking=True) for k, v in inputs.items()}
+        return {k: v.to(self.device) for k, v in inputs.items()}
+    
     def generate_text(self, prompt: str, max_length: int = 200, temperature: float = 0.7, top_p: float = 0.9) -> Optional[str]:
         """Generate text based on prompt"""
         if not self.model or not self.tokenizer:
             return None
         
         try:
-            # Prepare the prompt with proper formatting
-            formatted_prompt = f"<|im_start|>user\n{prompt}<|im_end|>\n<|im_start|>assistant\n"
-            
-            # Tokenize
-            inputs = self.tokenizer(
-                formatted_prompt,
+            # Let the tokenizer's own chat template build and tokenize the prompt in one call
+            inputs = self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": prompt}],
+                add_generation_prompt=True,
+                tokenize=True,
+                return_dict=True,
                 return_tensors="pt",
                 truncation=True,
                 max_length=2048
             )
             
             # Move to device
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+            inputs = self._to_device(inputs)
             
             # Generate
-            with torch.no_grad():
+            with torch.inference_mode():
                 outputs = self.model.generate(
                     **inputs,
                     max_new_tokens=max_length,
@@ -120,20 +180,17 @@ class ModelManager:
                     no_repeat_ngram_size=3
                 )
             
-            # Decode response
+            # Decode response; skip_special_tokens already drops <|im_end|>
             response = self.tokenizer.decode(
                 outputs[0][inputs['input_ids'].shape[1]:],
-                skip_special_tokens=True
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False
             ).strip()
             
-            # Clean up the response
-            if response.endswith('<|im_end|>'):
-                response = response[:-10].strip()
-            
             return response
             
         except Exception as e:
-            print(f"Error generating text: {str(e)}")
+            logger.exception("Error generating text: %s", e)
             return None
     
     def generate_chat_response(self, conversation_context: str, max_length: int = 300, temperature: float = 0.7, top_p: float = 0.9) -> Optional[str]:
@@ -151,12 +208,15 @@ class ModelManager:
             )
             
             # Move to device
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+            inputs = self._to_device(inputs)
             
             # Generate
-            with torch.no_grad():
+            with torch.inference_mode():
                 outputs = self.model.generate(
                     **inputs,
+                    past_key_values=self._take_kv(inputs['input_ids']),
+                    use_cache=True,
+                    return_dict_in_generate=True,
                     max_new_tokens=max_length,
                     temperature=temperature,
                     top_p=top_p,
@@ -166,25 +226,112 @@ class ModelManager:
                     repetition_penalty=1.1,
                     no_repeat_ngram_size=2
                 )
+            self._store_kv(outputs)
             
-            # Decode response
+            # Decode response; skip_special_tokens already drops <|im_end|>
             response = self.tokenizer.decode(
-                outputs[0][inputs['input_ids'].shape[1]:],
-                skip_special_tokens=True
+                outputs.sequences[0][inputs['input_ids'].shape[1]:],
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False
             ).strip()
             
-            # Clean up the response
-            if response.endswith('<|im_end|>'):
-                response = response[:-10].strip()
-            
             return response
             
         except Exception as e:
-            print(f"Error generating chat response: {str(e)}")
+            logger.exception("Error generating chat response: %s", e)
+            return None
+    
+    def generate_chat_stream(self, conversation_context: str, max_length: int = 300, temperature: float = 0.7, top_p: float = 0.9) -> Iterator[str]:
+        """Stream chat response text as it is generated"""
+        if not self.model or not self.tokenizer:
+            return
+        
+        try:
+            inputs = self.tokenizer(
+                conversation_context,
+                return_tensors="pt",
+                truncation=True,
+                max_length=2048
+            )
+            inputs = self._to_device(inputs)
+            
+            # The timeout bounds each wait for the next chunk, so a stalled worker can't hang the script thread
+            streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, timeout=STREAM_TIMEOUT, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+            generation_kwargs = dict(
+                **inputs,
+                streamer=streamer,
+                past_key_values=self._take_kv(inputs['input_ids']),
+                use_cache=True,
+                return_dict_in_generate=True,
+                max_new_tokens=max_length,
+                temperature=temperature,
+                top_p=top_p,
+                do_sample=True,
+                pad_token_id=self.tokenizer.pad_token_id,
+                eos_token_id=self.tokenizer.eos_token_id,
+                repetition_penalty=1.1,
+                no_repeat_ngram_size=2
+            )
+            
+            # generate() blocks until done, so it runs on a worker while this generator drains the streamer
+            error = []
+            def run_generate():
+                try:
+                    with torch.inference_mode():
+                        self._store_kv(self.model.generate(**generation_kwargs))
+                except Exception as e:
+                    error.append(e)
+                finally:
+                    # Unblocks the consumer even when generate() failed before finishing the stream
+                    streamer.end()
+            
+            worker = threading.Thread(target=run_generate, daemon=True)
+            worker.start()
+            yield from streamer
+            worker.join()
+            if error:
+                raise error[0]
+            
+        except Exception as e:
+            # Re-raised so the caller falls back instead of keeping a truncated reply
+            logger.error("Error streaming chat response: %s", e)
+            raise
+    
+    def _take_kv(self, input_ids):
+        """Check out the cached KV prefix shared with input_ids, or None to prefill from scratch"""
+        with self._kv_lock:
+            kv, kv_ids = self._kv, self._kv_ids
+            # Checked out, not shared: a concurrent generation starts cold instead of racing on it
+            self._kv = self._kv_ids = None
+        if kv is None or not hasattr(kv, "crop"):
             return None
+        
+        ids = input_ids[0]
+        # At least one new token must be left for the forward pass
+        n = min(kv_ids.shape[0], ids.shape[0] - 1)
+        mismatch = (kv_ids[:n] != ids[:n]).nonzero()
+        if len(mismatch):
+            n = int(mismatch[0])
+        if n <= 0:
+            return None
+        # Drop everything past the common prefix, e.g. an assistant reply that retokenized differently
+        kv.crop(n)
+        return kv
+    
+    def _store_kv(self, outputs):
+        """Keep the KV cache of a finished generation for the next turn"""
+        kv = getattr(outputs, "past_key_values", None)
+        if kv is None or not hasattr(kv, "get_seq_length"):
+            return
+        with self._kv_lock:
+            self._kv = kv
+            self._kv_ids = outputs.sequences[0][:kv.get_seq_length()]
     
     def cleanup(self):
         """Clean up model and free memory"""
+        with self._kv_lock:
+            self._kv = self._kv_ids = None
+        
         if self.model:
             del self.model
         if self.tokenizer:
@@ -210,6 +357,7 @@ class ModelManager:
             "model_name": self.model_name,
             "device": self.device,
             "loaded": self.is_loaded(),
+            "quantization": self.quantization,
             "cuda_available": torch.cuda.is_available(),
             "memory_usage": torch.cuda.memory_allocated() if torch.cuda.is_available() else 0
         }
@@ -1,16 +1,7 @@
 import streamlit as st
 
-class UIComponents:
-    def __init__(self):
-        self.korean_support = True
-    
-    def render_welcome_screen(self):
-        """Render ChatGPT-style welcome screen"""
-        col1, col2, col3 = st.columns([1, 2, 1])
-        with col2:
-            st.markdown("<br>", unsafe_allow_html=True)
-            if st.session_state.language == 'ko':
-                st.markdown("""
+# Welcome markdown is static; kept verbatim (including indentation) from the original render
+_WELCOME_KO = """
                 <div style="text-align: center;">
                 ## 🤖 HB AI
                 **Qwen2.5 7B를 활용한 지능형 대화 어시스턴트**
@@ -26,9 +17,9 @@ class UIComponents:
                 <br>
                 **지금 바로 새 채팅을 시작하여 HB AI와 대화해보세요!**
                 </div>
-                """, unsafe_allow_html=True)
-            else:
-                st.markdown("""
+                """
+
+_WELCOME_EN = """
                 <div style="text-align: center;">
                 ## 🤖 HB AI
                 **Intelligent Conversation Assistant powered by Qwen2.5 7B**
@@ -44,7 +35,21 @@ class UIComponents:
                 <br>
                 **Start a new chat now and begin conversing with HB AI!**
                 </div>
-                """, unsafe_allow_html=True)
+                """
+
+class UIComponents:
+    def __init__(self):
+        self.korean_support = True
+    
+    def render_welcome_screen(self):
+        """Render ChatGPT-style welcome screen"""
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col2:
+            st.markdown("<br>", unsafe_allow_html=True)
+            if st.session_state.language == 'ko':
+                st.markdown(_WELCOME_KO, unsafe_allow_html=True)
+            else:
+                st.markdown(_WELCOME_EN, unsafe_allow_html=True)
 
     def render_loading_spinner(self, text=None):
         if text: